@@ -1,16 +1,28 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List, Literal
+import hashlib
+import logging
 import os
+import time
+from cachetools import LRUCache
 from dotenv import load_dotenv
 import uvicorn
 from models import HuggingFaceClient
 
+logger = logging.getLogger("docanalyzer")
+
+# Cross-request answer cache keyed by (question, document) — repeat questions
+# are served without touching the model layer at all
+answer_cache = LRUCache(maxsize=2000)
+
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="DocAnalyzer Python API", version="1.0.0")
+app = FastAPI(title="DocAnalyzer Python API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Configure CORS for Next.js frontend
 app.add_middleware(
@@ -21,13 +33,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress multi-KB markdown answers (no-op for responses under 1 KB)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Initialize HuggingFace client
 hf_client = HuggingFaceClient()
 
 class ChatRequest(BaseModel):
-    question: str
-    document_text: str
-    chunks: Optional[List[str]] = []
+    # Strip and reject empty strings in pydantic-core (Rust) instead of
+    # re-checking by hand in the handler; unknown fields are rejected too
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True)
+
+    question: str = Field(min_length=1)
+    document_text: str = Field(min_length=1)
+    # Plain list[str] compiles a single pydantic-core validator; Optional
+    # added a needless None branch since the default was [] anyway
+    chunks: List[str] = Field(default_factory=list)
+    cache_mode: Literal["on", "read_only", "off"] = "on"
+    stream: bool = False
 
 class ChatResponse(BaseModel):
     answer: str
@@ -54,12 +77,24 @@ async def root():
         }
     }
 
+# /health gets polled by load balancers; reuse the model probe for 30s
+HEALTH_CACHE_TTL = 30.0
+_models_status_cache = (0.0, None)  # (expiry, value)
+
+async def _cached_models_status() -> List[str]:
+    global _models_status_cache
+    expiry, value = _models_status_cache
+    if value is None or time.monotonic() >= expiry:
+        value = await hf_client.check_models()
+        _models_status_cache = (time.monotonic() + HEALTH_CACHE_TTL, value)
+    return value
+
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
     """Health check endpoint"""
     try:
-        models_status = await hf_client.check_models()
-        
+        models_status = await _cached_models_status()
+
         return HealthResponse(
             status="healthy",
             python_api="running",
@@ -75,39 +110,70 @@ async def health_check():
         )
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat_with_document(request: ChatRequest):
+async def chat_with_document(request: ChatRequest, raw_request: Request):
     """Process chat request with document context"""
     try:
-        print(f"🐍 Python API: Processing question: {request.question[:50]}...")
-        print(f"📄 Document length: {len(request.document_text)} chars")
-        print(f"🔗 Chunks provided: {len(request.chunks)}")
-        
-        if not request.question.strip():
-            raise HTTPException(status_code=400, detail="Question cannot be empty")
-        
-        if not request.document_text.strip():
-            raise HTTPException(status_code=400, detail="Document text cannot be empty")
+        logger.debug("🐍 Python API: Processing question: %.50s...", request.question)
+        logger.debug("📄 Document length: %d chars", len(request.document_text))
+        logger.debug("🔗 Chunks provided: %d", len(request.chunks))
         
+        if request.stream:
+            async def token_stream():
+                async for token in hf_client.stream_response(
+                    question=request.question,
+                    document_text=request.document_text,
+                    chunks=request.chunks
+                ):
+                    if await raw_request.is_disconnected():
+                        logger.debug("🔌 Client disconnected, aborting stream")
+                        break
+                    yield token
+
+            # Pre-set Content-Encoding so GZipMiddleware passes the stream
+            # through untouched — gzip would buffer the tokens until close,
+            # collapsing the stream into one end-of-response burst
+            return StreamingResponse(
+                token_stream(),
+                media_type="text/event-stream",
+                headers={"Content-Encoding": "identity"}
+            )
+
+        cache_key = hashlib.sha256(
+            (request.question.lower() + "::" + request.document_text).encode()
+        ).digest()
+
+        if request.cache_mode in ("on", "read_only") and cache_key in answer_cache:
+            logger.debug("⚡ Answer cache hit")
+            return ORJSONResponse(content=answer_cache[cache_key])
+
         # Process with HuggingFace
         result = await hf_client.generate_response(
             question=request.question,
             document_text=request.document_text,
-            chunks=request.chunks
+            chunks=request.chunks,
+            cache_mode=request.cache_mode
         )
         
-        print(f"✅ Python API: Response generated successfully")
+        logger.debug("✅ Python API: Response generated successfully")
         
-        return ChatResponse(
-            answer=result["answer"],
-            model_used=result["model"],
-            processing_time=result["processing_time"],
-            relevant_chunks=len(request.chunks)
-        )
+        content = {
+            "answer": result["answer"],
+            "model_used": result["model"],
+            "processing_time": result["processing_time"],
+            "relevant_chunks": len(request.chunks)
+        }
+
+        # Only cache real answers, not error/fallback responses
+        if request.cache_mode == "on" and result["model"] not in ("none", "error", "fallback"):
+            answer_cache[cache_key] = content
+
+        # Return ORJSONResponse directly to skip Pydantic re-serialization
+        return ORJSONResponse(content=content)
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Python API Error: {str(e)}")
+        logger.error("❌ Python API Error: %s", e)
         raise HTTPException(
             status_code=500, 
             detail=f"Internal server error: {str(e)}"
@@ -128,10 +194,27 @@ if __name__ == "__main__":
     print("🐍 Python API will run on http://localhost:8000")
     print("📚 API docs available at http://localhost:8000/docs")
     
-    uvicorn.run(
-        "main:app",
-        host="127.0.0.1",
-        port=8000,
-        reload=True,
-        log_level="info"
-    )
\ No newline at end of file
+    if os.getenv("ENV") == "prod":
+        # Production: no reloader process, one worker per core
+        uvicorn.run(
+            "main:app",
+            host="127.0.0.1",
+            port=8000,
+            reload=False,
+            workers=max(2, os.cpu_count()),
+            log_level="warning",
+            access_log=False,
+            loop="uvloop",
+            http="httptools"
+        )
+    else:
+        uvicorn.run(
+            "main:app",
+            host="127.0.0.1",
+            port=8000,
+            reload=True,
+            log_level="warning",
+            access_log=False,
+            loop="uvloop",
+            http="httptools"
+        )
\ No newline at end of file
@@ -1,7 +1,39 @@
+import asyncio
+import hashlib
+import heapq
+import json
+import logging
 import os
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
 
+try:
+    import numpy as np
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    VECTOR_SEARCH_AVAILABLE = True
+except ImportError:
+    VECTOR_SEARCH_AVAILABLE = False
+
+logger = logging.getLogger("docanalyzer")
+
+# How many models one request races before falling back sequentially
+PARALLEL_MODEL_ATTEMPTS = 3
+
+# Worker-wide cap on in-flight upstream calls across all requests — must be
+# comfortably larger than the race width or one request starves the rest
+MAX_CONCURRENT_MODEL_CALLS = 12
+
+# Context budget in cl100k_base tokens (leaves room for the 400-token answer)
+CONTEXT_TOKEN_BUDGET = 1800
+
+# Per-model deadline so one hung endpoint can't own the whole /chat request
+MODEL_TIMEOUT_SECONDS = 8.0
+
+SYSTEM_PROMPT = "You are a helpful assistant that answers questions based on provided documents. Be concise and accurate. Format your response using markdown when appropriate (use **bold**, ### headings, - bullet points, etc.)."
+
 class HuggingFaceClient:
     def __init__(self):
         self.api_key = os.getenv('HUGGINGFACE_API_KEY')
@@ -30,14 +62,52 @@ class HuggingFaceClient:
             "google/gemma-2-9b-it",
             "google/gemma-2-2b-it",
         ]
-        
-        print(f"🤗 HuggingFace Client initialized (Clean Version)")
-        print(f"🔑 API Key available: {bool(self.api_key and self.api_key.startswith('hf_'))}")
-        if self.api_key:
-            print(f"🔑 API Key starts with: {self.api_key[:8]}...")
-        else:
-            print("❌ No HuggingFace API key found in environment!")
-            print("💡 Get your token from: https://huggingface.co/settings/tokens")
+
+        # Per-document cache of tokenized chunk representations (TF-IDF
+        # matrix and/or word sets), keyed by a hash of the chunk contents
+        self._chunk_cache = OrderedDict()
+        self._chunk_cache_max = 32
+        # Scoring runs on _scoring_pool threads, so cache access needs a lock
+        self._chunk_cache_lock = threading.Lock()
+
+        # In-process LRU cache for repeated (model, context, question) pairs
+        self._response_cache = OrderedDict()
+        self._response_cache_max = 256
+
+        # Optional on-disk cache so answers survive server restarts
+        try:
+            from diskcache import Cache
+            self._disk_cache = Cache(".hf_cache")
+        except ImportError:
+            self._disk_cache = None
+
+        # One async client reused for every request and model fallback, so
+        # pooled TLS connections stay alive instead of renegotiating per call
+        try:
+            from huggingface_hub import AsyncInferenceClient
+            self.client = AsyncInferenceClient(api_key=self.api_key, timeout=30.0)
+        except ImportError:
+            self.client = None
+
+        # Tokenizer for truncating context by real token count
+        try:
+            import tiktoken
+            self._enc = tiktoken.get_encoding("cl100k_base")
+        except ImportError:
+            self._enc = None
+
+        # Cap concurrent upstream calls so racing models doesn't trip HF rate limits
+        self._model_semaphore = asyncio.Semaphore(MAX_CONCURRENT_MODEL_CALLS)
+
+        # Chunk scoring runs here so the CPU work (numpy releases the GIL
+        # in BLAS) doesn't stall the event loop
+        self._scoring_pool = ThreadPoolExecutor(max_workers=4)
+
+        logger.info("🤗 HuggingFace Client initialized (Clean Version)")
+        logger.info("🔑 API Key available: %s", bool(self.api_key and self.api_key.startswith('hf_')))
+        if not self.api_key:
+            logger.warning("❌ No HuggingFace API key found in environment!")
+            logger.warning("💡 Get your token from: https://huggingface.co/settings/tokens")
     
     def is_available(self) -> bool:
         """Check if HuggingFace API is available"""
@@ -46,35 +116,251 @@ class HuggingFaceClient:
     async def check_models(self) -> List[str]:
         """Check which models are available"""
         if not self.is_available():
-            print("❌ No API key - cannot check models")
+            logger.debug("❌ No API key - cannot check models")
             return []
         
-        print("✅ Using clean HuggingFace chat_completion API")
+        logger.debug("✅ Using clean HuggingFace chat_completion API")
         return self.models[:3]  # Return first 3 for compatibility
     
     async def list_models(self) -> List[str]:
         """List all configured models"""
         return self.models
     
+    def _cache_key(self, model_name: str, context: str, question: str) -> str:
+        """Build a deterministic cache key for a (model, context, question) pair"""
+        payload = json.dumps(
+            {"model": model_name, "sys": SYSTEM_PROMPT, "ctx": context, "q": question},
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _cache_get(self, key: str) -> Optional[str]:
+        """Look up a cached answer in memory first, then on disk"""
+        if key in self._response_cache:
+            self._response_cache.move_to_end(key)
+            return self._response_cache[key]
+
+        if self._disk_cache is not None:
+            answer = self._disk_cache.get(key)
+            if answer:
+                return answer
+
+        return None
+
+    def _cache_set(self, key: str, answer: str):
+        """Store an answer in the LRU (and disk cache if available)"""
+        self._response_cache[key] = answer
+        self._response_cache.move_to_end(key)
+        while len(self._response_cache) > self._response_cache_max:
+            self._response_cache.popitem(last=False)
+
+        if self._disk_cache is not None:
+            self._disk_cache.set(key, answer, expire=3600)
+
     def find_relevant_chunks(self, question: str, chunks: List[str], top_k: int = 3) -> List[str]:
         """Find most relevant chunks for the question"""
         if not chunks:
             return []
-        
+
+        if VECTOR_SEARCH_AVAILABLE:
+            try:
+                return self._tfidf_top_k(question, chunks, top_k)
+            except ValueError:
+                # Vocabulary can end up empty (e.g. punctuation-only chunks)
+                pass
+
+        return self._overlap_top_k(question, chunks, top_k)
+
+    def _chunk_cache_entry(self, chunks: List[str]) -> Dict:
+        """Get (or create) the cached representations for a chunk list
+
+        Keyed by a hash of the chunk contents, so follow-up questions on
+        the same document reuse the work even though the request sends a
+        fresh list each time. Oldest documents are evicted past 32.
+        """
+        key = hashlib.blake2b(b"\x00".join(c.encode() for c in chunks), digest_size=16).hexdigest()
+        with self._chunk_cache_lock:
+            entry = self._chunk_cache.get(key)
+            if entry is None:
+                entry = {}
+                self._chunk_cache[key] = entry
+            self._chunk_cache.move_to_end(key)
+            while len(self._chunk_cache) > self._chunk_cache_max:
+                self._chunk_cache.popitem(last=False)
+            return entry
+
+    def _tfidf_top_k(self, question: str, chunks: List[str], top_k: int) -> List[str]:
+        """Score chunks with a cached TF-IDF matrix and one sparse matmul"""
+        entry = self._chunk_cache_entry(chunks)
+        with self._chunk_cache_lock:
+            if "tfidf" not in entry:
+                vectorizer = TfidfVectorizer()
+                # Rows are L2-normalized, so cosine similarity is a dot product
+                matrix = vectorizer.fit_transform(chunks)
+                entry["tfidf"] = (vectorizer, matrix)
+
+            vectorizer, matrix = entry["tfidf"]
+        query = vectorizer.transform([question])
+        scores = (matrix @ query.T).toarray().ravel()
+
+        if top_k >= len(chunks):
+            idx = np.argsort(-scores)
+        else:
+            idx = np.argpartition(-scores, top_k)[:top_k]
+            idx = idx[np.argsort(-scores[idx])]
+
+        return [chunks[i] for i in idx]
+
+    def _overlap_top_k(self, question: str, chunks: List[str], top_k: int) -> List[str]:
+        """Fallback word-overlap scoring when sklearn/numpy are unavailable"""
+        entry = self._chunk_cache_entry(chunks)
+        with self._chunk_cache_lock:
+            if "word_sets" not in entry:
+                entry["word_sets"] = [frozenset(chunk.lower().split()) for chunk in chunks]
+            word_sets = entry["word_sets"]
+
         question_words = set(question.lower().split())
         scored_chunks = []
-        
-        for chunk in chunks:
-            chunk_words = set(chunk.lower().split())
+
+        for chunk, chunk_words in zip(chunks, word_sets):
             # Simple word overlap scoring
             overlap = len(question_words.intersection(chunk_words))
             scored_chunks.append((chunk, overlap))
-        
-        # Sort by overlap score and return top_k
-        scored_chunks.sort(key=lambda x: x[1], reverse=True)
-        return [chunk for chunk, _ in scored_chunks[:top_k]]
+
+        # O(N log k) top-k instead of sorting the whole list
+        top = heapq.nlargest(top_k, scored_chunks, key=lambda x: x[1])
+        return [chunk for chunk, _ in top]
     
-    async def generate_response(self, question: str, document_text: str, chunks: List[str] = None) -> Dict:
+    async def _build_context(self, question: str, document_text: str, chunks: Optional[List[str]]) -> str:
+        """Pick the context to send: top chunks if provided, else a document prefix"""
+        # Find relevant context (scored off the event loop)
+        if chunks:
+            relevant_chunks = await asyncio.get_running_loop().run_in_executor(
+                self._scoring_pool, self.find_relevant_chunks, question, chunks, 3
+            )
+            context = "\n\n".join(relevant_chunks)
+        else:
+            context = document_text[:1500]  # Use first 1500 chars if no chunks
+
+        # Truncate by true token count (char-to-token ratios vary 2-5x, so a
+        # character cut both wastes window and can slice mid-token)
+        if self._enc is not None:
+            # disallowed_special=() — documents may legitimately contain
+            # special-token literals like <|endoftext|>; the default raises
+            tokens = self._enc.encode(context, disallowed_special=())
+            if len(tokens) > CONTEXT_TOKEN_BUDGET:
+                context = self._enc.decode(tokens[:CONTEXT_TOKEN_BUDGET]) + "..."
+        elif len(context) > 2000:
+            context = context[:2000] + "..."
+
+        return context
+
+    def _build_messages(self, context: str, question: str) -> List[Dict]:
+        """Create the chat messages — identical for every model attempt"""
+        return [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": f"Document: {context}\n\nQuestion: {question}\n\nPlease answer the question based on the document above. Use markdown formatting to make your response clear and well-structured."
+            }
+        ]
+
+    async def _try_model(self, model_name: str, messages: List[Dict]) -> tuple:
+        """Attempt one chat completion, returning (model_name, answer or None)"""
+        async def attempt():
+            # Deadline covers waiting for a permit too, so a busy semaphore
+            # can't stretch the attempt past its budget
+            async with self._model_semaphore:
+                logger.debug("🎯 Trying model: %s", model_name)
+
+                # Use chat completion (async so the event loop stays free)
+                return await self.client.chat_completion(
+                    model=model_name,
+                    messages=messages,
+                    max_tokens=400,
+                    temperature=0.7
+                )
+
+        try:
+            # asyncio.wait_for, not asyncio.timeout — the backend supports 3.9
+            response = await asyncio.wait_for(attempt(), MODEL_TIMEOUT_SECONDS)
+
+        except asyncio.TimeoutError:
+            logger.debug("⏱️ Model %s timed out after %ss, trying next...", model_name, MODEL_TIMEOUT_SECONDS)
+            return model_name, None
+
+        except Exception as e:
+            logger.debug("❌ Model %s failed: %s", model_name, e)
+
+            # Check for specific errors
+            if "404" in str(e):
+                logger.debug("➡️ Model %s not available, trying next...", model_name)
+            elif "401" in str(e) or "unauthorized" in str(e).lower():
+                logger.debug("🔑 Unauthorized for %s - check API key permissions", model_name)
+            elif "429" in str(e) or "rate" in str(e).lower():
+                logger.debug("⚠️ Rate limited for %s, trying next...", model_name)
+            else:
+                logger.debug("❌ Unexpected error with %s: %s", model_name, e)
+            return model_name, None
+
+        # Extract answer from response
+        if response and response.choices:
+            answer = response.choices[0].message.content.strip()
+            if answer and len(answer) > 10:
+                return model_name, answer
+
+        return model_name, None
+
+    async def stream_response(self, question: str, document_text: str, chunks: Optional[List[str]] = None):
+        """Stream answer tokens from the first model that accepts the request"""
+        if not self.is_available() or self.client is None:
+            # Reuse the canned setup-help answers from the non-streaming path
+            result = await self.generate_response(question, document_text, chunks, cache_mode="off")
+            yield result["answer"]
+            return
+
+        context = await self._build_context(question, document_text, chunks)
+        messages = self._build_messages(context, question)
+
+        for model_name in self.models:
+            started = False
+            try:
+                async def connect():
+                    async with self._model_semaphore:
+                        logger.debug("🎯 Streaming from model: %s", model_name)
+
+                        return await self.client.chat_completion(
+                            model=model_name,
+                            messages=messages,
+                            max_tokens=400,
+                            temperature=0.7,
+                            stream=True
+                        )
+
+                # Permit and deadline cover connection setup only — holding
+                # them across yields would tie them to however slowly the
+                # client reads, and generation may legitimately take longer
+                stream = await asyncio.wait_for(connect(), MODEL_TIMEOUT_SECONDS)
+
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        started = True
+                        yield chunk.choices[0].delta.content
+                return
+
+            except Exception as e:
+                logger.debug("❌ Model %s failed: %s", model_name, e)
+                if started:
+                    # Tokens already went out — switching models would duplicate text
+                    return
+                continue
+
+        yield "❌ **All AI Models Failed**\n\nPlease try again in 30-60 seconds."
+
+    async def generate_response(self, question: str, document_text: str, chunks: Optional[List[str]] = None, cache_mode: str = "on") -> Dict:
         """Generate response using HuggingFace chat_completion API"""
         start_time = time.time()
         
@@ -85,91 +371,76 @@ class HuggingFaceClient:
                 "processing_time": time.time() - start_time
             }
         
-        # Find relevant context
-        if chunks:
-            relevant_chunks = self.find_relevant_chunks(question, chunks, 3)
-            context = "\n\n".join(relevant_chunks)
-        else:
-            context = document_text[:1500]  # Use first 1500 chars if no chunks
-        
-        # Truncate context if too long
-        if len(context) > 2000:
-            context = context[:2000] + "..."
-        
-        print(f"📝 Context length: {len(context)} characters")
-        
-        # Use the working HuggingFace API
-        try:
-            from huggingface_hub import InferenceClient
-            
-            # Initialize client
-            client = InferenceClient(api_key=self.api_key)
-            
-            # Try each model until one works
+        context = await self._build_context(question, document_text, chunks)
+        logger.debug("📝 Context length: %d characters", len(context))
+
+        # Serve a cached answer if we already answered this exact question
+        if cache_mode in ("on", "read_only"):
             for model_name in self.models:
-                try:
-                    print(f"🎯 Trying model: {model_name}")
-                    
-                    # Create messages for chat completion
-                    messages = [
-                        {
-                            "role": "system",
-                            "content": "You are a helpful assistant that answers questions based on provided documents. Be concise and accurate. Format your response using markdown when appropriate (use **bold**, ### headings, - bullet points, etc.)."
-                        },
-                        {
-                            "role": "user", 
-                            "content": f"Document: {context}\n\nQuestion: {question}\n\nPlease answer the question based on the document above. Use markdown formatting to make your response clear and well-structured."
-                        }
-                    ]
-                    
-                    # Use chat completion
-                    response = client.chat_completion(
-                        model=model_name,
-                        messages=messages,
-                        max_tokens=400,
-                        temperature=0.7
-                    )
-                    
-                    # Extract answer from response
-                    if response and response.choices:
-                        answer = response.choices[0].message.content.strip()
-                        
-                        if answer and len(answer) > 10:
-                            processing_time = time.time() - start_time
-                            print(f"✅ Success with {model_name} in {processing_time:.2f}s")
-                            
-                            # Return clean answer without prefix
-                            return {
-                                "answer": answer,  # 🔥 CLEAN - No prefix!
-                                "model": model_name,
-                                "processing_time": processing_time
-                            }
-                
-                except Exception as e:
-                    print(f"❌ Model {model_name} failed: {str(e)}")
-                    
-                    # Check for specific errors
-                    if "404" in str(e):
-                        print(f"➡️ Model {model_name} not available, trying next...")
-                        continue
-                    elif "401" in str(e) or "unauthorized" in str(e).lower():
-                        print(f"🔑 Unauthorized for {model_name} - check API key permissions")
-                        continue
-                    elif "429" in str(e) or "rate" in str(e).lower():
-                        print(f"⚠️ Rate limited for {model_name}, trying next...")
-                        continue
-                    else:
-                        print(f"❌ Unexpected error with {model_name}: {str(e)}")
-                        continue
-            
-        except ImportError:
+                cached_answer = self._cache_get(self._cache_key(model_name, context, question))
+                if cached_answer:
+                    logger.debug("⚡ Cache hit for %s", model_name)
+                    return {
+                        "answer": cached_answer,
+                        "model": model_name,
+                        "processing_time": time.time() - start_time
+                    }
+
+        if self.client is None:
             return {
                 "answer": "🔧 **Missing Dependency**\n\nPlease install the updated huggingface_hub:\n\n```bash\npip install huggingface_hub>=0.28.0\n```\n\nThen restart the Python server.",
                 "model": "error",
                 "processing_time": time.time() - start_time
             }
+
+        messages = self._build_messages(context, question)
+
+        # Use the working HuggingFace API
+        try:
+            answer = None
+            model_used = None
+
+            # Race the primary models concurrently — first good answer wins
+            tasks = [
+                asyncio.create_task(self._try_model(m, messages))
+                for m in self.models[:PARALLEL_MODEL_ATTEMPTS]
+            ]
+            try:
+                for future in asyncio.as_completed(tasks):
+                    candidate_model, candidate_answer = await future
+                    if candidate_answer:
+                        answer = candidate_answer
+                        model_used = candidate_model
+                        break
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+            # Fall back to the remaining models one at a time
+            if answer is None:
+                for model_name in self.models[PARALLEL_MODEL_ATTEMPTS:]:
+                    candidate_model, candidate_answer = await self._try_model(model_name, messages)
+                    if candidate_answer:
+                        answer = candidate_answer
+                        model_used = candidate_model
+                        break
+
+            if answer:
+                processing_time = time.time() - start_time
+                logger.debug("✅ Success with %s in %.2fs", model_used, processing_time)
+
+                if cache_mode == "on":
+                    self._cache_set(self._cache_key(model_used, context, question), answer)
+
+                # Return clean answer without prefix
+                return {
+                    "answer": answer,  # 🔥 CLEAN - No prefix!
+                    "model": model_used,
+                    "processing_time": processing_time
+                }
+
         except Exception as e:
-            print(f"❌ Inference Client error: {str(e)}")
+            logger.warning("❌ Inference Client error: %s", e)
         
         # If all models failed, return a fallback response
         processing_time = time.time() - start_time